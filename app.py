@@ -1,24 +1,71 @@
 from flask import Flask, render_template
 from bokeh.embed import components
-from database import BillInfo
-from plot import ExecutionStatusPlotter, BillInfoPlotter
+import click
+from cache import shared_cache
+from database import BillInfo, MonthlyRollup, DailyExecutionSummary
+from plot import ExecutionStatusPlotter, BillInfoPlotter, MonthlySummaryPlotter
 
 app = Flask(__name__)
 
 
 @app.route('/')
+@shared_cache.cached('index')
 def index():
 
     plotters = [ExecutionStatusPlotter(), BillInfoPlotter()]
+    if MonthlyRollup.is_backfilled():
+        plotters.append(MonthlySummaryPlotter())
 
-    script, (exec_status_plot_div, bill_info_plot_div) = components([x.make_plot_layout() for x in plotters])
+    script, divs = components([x.make_plot_layout() for x in plotters])
+    exec_status_plot_div, bill_info_plot_div = divs[:2]
+    summary_plot_div = divs[2] if len(divs) > 2 else \
+        '<p>The monthly summary has not been backfilled yet. Run <code>flask rebuild-rollups</code>.</p>'
 
     return render_template('dashboard.html',
                            script=script,
                            exec_status_plot_div=exec_status_plot_div,
-                           bill_info_plot_div=bill_info_plot_div)
+                           bill_info_plot_div=bill_info_plot_div,
+                           summary_plot_div=summary_plot_div)
 
 
 @app.route('/data/')
+@shared_cache.cached('data')
 def data():
     return BillInfo.objects.to_json()
+
+
+@app.route('/summary/')
+@shared_cache.cached('summary')
+def summary():
+    return MonthlyRollup.objects.order_by('service_name', 'month').to_json()
+
+
+@app.route('/reliability/')
+@shared_cache.cached('reliability')
+def reliability():
+    return DailyExecutionSummary.objects.order_by('service_name', 'day').to_json()
+
+
+@app.cli.command('rebuild-rollups')
+def rebuild_rollups():
+    """Rebuild the MonthlyRollup collection from the bill and execution history.
+
+    Maintenance only: do not run this while scrapers or execution compaction are running.
+    """
+    print('Rebuilt {} monthly rollups'.format(MonthlyRollup.rebuild()))
+    shared_cache.invalidate()
+
+
+@app.cli.command('compact-executions')
+@click.option('--days', default=DailyExecutionSummary.RETENTION_DAYS,
+              help='Number of days of raw execution history to keep.')
+def compact_executions(days):
+    """Compact ExecutionStatus documents older than the retention period into daily summaries."""
+    print('Compacted {} execution records'.format(DailyExecutionSummary.compact_executions(days)))
+    shared_cache.invalidate()
+
+
+@app.cli.command('clear-cache')
+def clear_cache():
+    """Invalidate the dashboard cache shared by all workers."""
+    shared_cache.invalidate()
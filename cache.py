@@ -0,0 +1,264 @@
+import fcntl
+import hashlib
+import json
+import logging
+import os
+import stat
+import tempfile
+import time
+from contextlib import contextmanager
+from functools import wraps
+
+logger = logging.getLogger(__name__)
+
+class SharedCache:
+    """
+    An on-disk cache that is shared between processes on the same machine (i.e. gunicorn workers).
+
+    Each entry is a JSON file that is written atomically, so readers never see a partial value.
+    Entries are evicted least-recently-used first once the total size exceeds max_bytes, and expire
+    after ttl seconds. Invalidation bumps a generation counter, which atomically orphans every
+    existing entry for all processes at once. A per-key file lock makes sure only one process
+    recomputes a missing value while the others wait for its result.
+
+    The cache directory must be private to the current user, because its contents are served as
+    dashboard responses. It is set up on first use. If it cannot be used (i.e. it belongs to another
+    user), a warning is logged and values are computed without caching.
+    """
+    def __init__(self, directory, max_bytes=64 * 1024 * 1024, ttl=300):
+        """
+        Constructor
+
+        :param directory: path of the directory that holds the cache files; created with mode 0o700
+                          on first use if it does not exist
+        :param max_bytes: maximum total size of the cached entries in bytes
+        :param ttl: number of seconds after which an entry is recomputed
+        """
+        self._directory = directory
+        self._entries_dir = os.path.join(directory, 'entries')
+        self._locks_dir = os.path.join(directory, 'locks')
+        self._generation_path = os.path.join(directory, 'generation')
+        self._max_bytes = max_bytes
+        self._ttl = ttl
+        self._usable = None
+
+    def get(self, key):
+        """
+        :param key: string key of the entry
+        :return: a (found, value) tuple; value is None if no live entry exists
+        """
+        if not self._is_usable():
+            return False, None
+        path = self._entry_path(key)
+        try:
+            with open(path, 'rb') as f:
+                created, value = json.loads(f.read().decode())
+        except (OSError, ValueError):
+            return False, None
+        if time.time() - created > self._ttl:
+            return False, None
+        try:
+            # Reading counts as a use for the LRU eviction order
+            os.utime(path)
+        except OSError:
+            pass
+        return True, value
+
+    def set(self, key, value):
+        """
+        Store a value in the cache and evict old entries if the cache is over its size limit
+
+        :param key: string key of the entry
+        :param value: any JSON serializable object (i.e. a str payload or a list of names)
+        """
+        if not self._is_usable():
+            return
+        self._store(self._entry_path(key), value)
+
+    def get_or_compute(self, key, compute):
+        """
+        Get a value from the cache, computing and storing it if it is missing.
+
+        If several processes miss at the same time, only one of them runs compute and the others
+        return its result.
+
+        :param key: string key of the entry
+        :param compute: a function with no arguments that returns the value
+        :return: the cached or freshly computed value
+        """
+        if not self._is_usable():
+            return compute()
+        found, value = self.get(key)
+        if found:
+            return value
+        with self._lock(self._hash(key)):
+            # Keep the generation from before computing, so a value computed from data that was
+            # invalidated meanwhile is stored as already stale
+            generation = self._get_generation()
+            found, value = self.get(key)
+            if not found:
+                value = compute()
+                self._store(self._entry_path(key, generation), value)
+        return value
+
+    def cached(self, key):
+        """
+        Decorator that caches the return value of a function with no arguments
+
+        :param key: string key of the entry
+        """
+        def decorator(func):
+            @wraps(func)
+            def wrapper():
+                return self.get_or_compute(key, func)
+            return wrapper
+        return decorator
+
+    def invalidate(self):
+        """
+        Invalidate every entry for all processes at once. Does nothing if the cache was never created.
+        """
+        if not os.path.isdir(self._directory) or not self._is_usable():
+            return
+        with self._lock('generation'):
+            self._write_atomic(self._generation_path, str(self._get_generation() + 1).encode())
+        self._evict()
+
+    def _is_usable(self):
+        """
+        Set up the cache directories on first use
+
+        :return: True if the cache directory is private to the current user and can be used
+        """
+        if self._usable is None:
+            try:
+                self._make_private_dir(self._directory)
+                self._make_private_dir(self._entries_dir)
+                self._make_private_dir(self._locks_dir)
+                self._usable = True
+            except OSError as error:
+                logger.warning('Caching disabled: %s', error)
+                self._usable = False
+        return self._usable
+
+    def _get_generation(self):
+        """
+        :return: the integer generation that current entries belong to
+        """
+        try:
+            with open(self._generation_path) as f:
+                return int(f.read())
+        except (OSError, ValueError):
+            return 0
+
+    def _entry_path(self, key, generation=None):
+        """
+        :param key: string key of the entry
+        :param generation: generation of the entry; defaults to the current generation
+        :return: path of the entry file
+        """
+        if generation is None:
+            generation = self._get_generation()
+        return os.path.join(self._entries_dir, '{}-{}.json'.format(generation, self._hash(key)))
+
+    def _store(self, path, value):
+        """
+        Write an entry file and evict old entries if the cache is over its size limit
+
+        :param path: path of the entry file
+        :param value: any JSON serializable object
+        """
+        self._write_atomic(path, json.dumps([time.time(), value]).encode())
+        self._evict()
+
+    def _evict(self):
+        """
+        Remove entries of old generations, then remove least recently used entries until the
+        cache fits in max_bytes
+        """
+        with self._lock('evict'):
+            prefix = '{}-'.format(self._get_generation())
+            entries = []
+            for entry in os.scandir(self._entries_dir):
+                if not entry.name.endswith('.json'):
+                    continue
+                try:
+                    if not entry.name.startswith(prefix):
+                        os.unlink(entry.path)
+                        continue
+                    info = entry.stat()
+                except FileNotFoundError:
+                    continue
+                entries.append((info.st_mtime, info.st_size, entry.path))
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in sorted(entries):
+                if total <= self._max_bytes:
+                    break
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                total -= size
+
+    @contextmanager
+    def _lock(self, name):
+        """
+        Hold an exclusive lock that is shared between processes
+
+        :param name: name of the lock
+        """
+        with open(os.path.join(self._locks_dir, name + '.lock'), 'w') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    @staticmethod
+    def _make_private_dir(path):
+        """
+        Create a directory that only the current user can access, or check that an existing one is
+
+        :param path: path of the directory
+        :raises PermissionError: if the directory exists but is not owned by the current user with mode 0o700
+        """
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        try:
+            os.mkdir(path, mode=0o700)
+        except FileExistsError:
+            pass
+        info = os.lstat(path)
+        if not stat.S_ISDIR(info.st_mode) or info.st_uid != os.getuid() or stat.S_IMODE(info.st_mode) != 0o700:
+            raise PermissionError('Refusing to use cache directory {}: it must be a directory owned by the '
+                                  'current user with mode 0o700'.format(path))
+
+    @staticmethod
+    def _write_atomic(path, data):
+        """
+        Write a file so that readers see either the old or the new content, never a partial one
+
+        :param path: path of the file
+        :param data: bytes to write
+        """
+        fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+
+    @staticmethod
+    def _hash(key):
+        """
+        :param key: string key of the entry
+        :return: a file name safe digest of the key
+        """
+        return hashlib.sha1(key.encode()).hexdigest()
+
+
+# Defaults to a cache folder inside the Flask instance folder (app.instance_path) of app.py
+shared_cache = SharedCache(os.environ.get('BILLS_CACHE_DIR',
+                                          os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'cache')))
@@ -1,8 +1,11 @@
 from abc import ABCMeta, abstractmethod
+import os
 from events import Observer, EventTypes
 from mongoengine import *
-from datetime import datetime
+from datetime import datetime, timedelta
+from uuid import uuid4
 from mongoengine.document import TopLevelDocumentMetaclass
+from pymongo import ASCENDING
 connect(db='bills', host='10.0.1.2', port=27017)
 
 
@@ -59,6 +62,7 @@ class BillInfo(Document, DatabaseItem, metaclass=Meta):
         """
         BillInfo.objects(service_name=self.service_name, date_due=self.date_due)\
             .update_one(set__amt_due=self.amt_due, upsert=True)
+        MonthlyRollup.refresh_bill_totals(self.service_name, self.date_due)
 
 
 class ExecutionStatus(Document, DatabaseItem, metaclass=Meta):
@@ -71,6 +75,15 @@ class ExecutionStatus(Document, DatabaseItem, metaclass=Meta):
     success = BooleanField(required=True)
     exec_time = DateTimeField(required=True)
     error_message = StringField()
+    duration = FloatField()
+    compaction_batch = StringField()
+
+    meta = {
+        'indexes': [
+            ('service_name', '-exec_time'),
+            'exec_time'
+        ]
+    }
 
     def to_dict(self):
         """
@@ -82,7 +95,8 @@ class ExecutionStatus(Document, DatabaseItem, metaclass=Meta):
             "service_name": self.service_name,
             "success": self.success,
             "exec_time": self.exec_time,
-            "error_message": self.error_message
+            "error_message": self.error_message,
+            "duration": self.duration
         }
 
     def save_no_dups(self):
@@ -93,8 +107,364 @@ class ExecutionStatus(Document, DatabaseItem, metaclass=Meta):
         time, update the success and error message with the new values. Otherwise,
         create a new document.
         """
-        ExecutionStatus.objects(service_name=self.service_name, exec_time=self.exec_time)\
-            .update_one(set__success=self.success, set__error_message=self.error_message, upsert=True)
+        # A single atomic write that also returns the previous document (None if it is new), so
+        # overlapping saves of the same execution cannot both count it
+        previous = ExecutionStatus.objects(service_name=self.service_name, exec_time=self.exec_time)\
+            .modify(upsert=True, new=False, set__success=self.success, set__error_message=self.error_message,
+                    set__duration=self.duration)
+        MonthlyRollup.record_execution(self.service_name, self.exec_time, self.success,
+                                       None if previous is None else previous.success)
+
+
+class MonthlyRollup(Document, DatabaseItem, metaclass=Meta):
+    """
+    A pre-aggregated summary of BillInfo and ExecutionStatus documents for a
+    single service and month.
+
+    Kept up to date by BillInfo.save_no_dups and ExecutionStatus.save_no_dups so
+    that dashboard statistics can be read in O(months) instead of O(documents).
+    Use MonthlyRollup.rebuild() to backfill from the raw collections and the compacted
+    DailyExecutionSummary history. Until that has been done once, the collection only holds the
+    months written since the upgrade, which MonthlyRollup.is_backfilled() reports.
+    """
+    service_name = StringField(required=True)
+    month = DateTimeField(required=True)
+    bill_total = DecimalField(precision=2, default=0)
+    bill_count = IntField(default=0)
+    bill_min = DecimalField(precision=2)
+    bill_max = DecimalField(precision=2)
+    success_count = IntField(default=0)
+    failure_count = IntField(default=0)
+
+    meta = {
+        'indexes': [
+            {'fields': ('service_name', 'month'), 'unique': True}
+        ]
+    }
+
+    @staticmethod
+    def month_start(date):
+        """
+        :param date: a date or datetime
+        :return: a datetime representing midnight on the first day of that date's month
+        """
+        return datetime(date.year, date.month, 1)
+
+    @staticmethod
+    def month_end(date):
+        """
+        :param date: a date or datetime
+        :return: a datetime representing midnight on the first day of the following month
+        """
+        if date.month == 12:
+            return datetime(date.year + 1, 1, 1)
+        return datetime(date.year, date.month + 1, 1)
+
+    def to_dict(self):
+        """
+        Convert object to dictionary for ease of loading into pandas for plotting
+
+        :return: a dictionary that represents this object
+        """
+        return {
+            "service_name": self.service_name,
+            "month": self.month,
+            "bill_total": self.bill_total,
+            "bill_count": self.bill_count,
+            "bill_min": self.bill_min,
+            "bill_max": self.bill_max,
+            "success_count": self.success_count,
+            "failure_count": self.failure_count
+        }
+
+    def save_no_dups(self):
+        """
+        Save this MonthlyRollup object to the database.
+
+        If there is already a document with this service name and month, replace
+        its statistics with the values on this object. Otherwise, create a new document.
+        """
+        MonthlyRollup.objects(service_name=self.service_name, month=MonthlyRollup.month_start(self.month))\
+            .update_one(set__bill_total=self.bill_total, set__bill_count=self.bill_count,
+                        set__bill_min=self.bill_min, set__bill_max=self.bill_max,
+                        set__success_count=self.success_count, set__failure_count=self.failure_count,
+                        upsert=True)
+
+    @staticmethod
+    def refresh_bill_totals(service_name, date_due):
+        """
+        Recompute the bill statistics of a single service and month from the BillInfo collection.
+
+        Only the bills of that month are read, so this stays cheap as history grows. Recomputing
+        (rather than incrementing) keeps the min/max correct when an existing bill amount is updated.
+
+        :param service_name: string name of the service (i.e. 'Comcast')
+        :param date_due: date or datetime of the bill that changed
+        """
+        start = MonthlyRollup.month_start(date_due)
+        amounts = [x.amt_due for x in BillInfo.objects(service_name=service_name, date_due__gte=start,
+                                                       date_due__lt=MonthlyRollup.month_end(date_due))
+                   .only('amt_due')]
+        MonthlyRollup.objects(service_name=service_name, month=start)\
+            .update_one(set__bill_total=sum(amounts), set__bill_count=len(amounts),
+                        set__bill_min=min(amounts, default=None), set__bill_max=max(amounts, default=None),
+                        upsert=True)
+
+    @staticmethod
+    def record_execution(service_name, exec_time, success, previous_success=None):
+        """
+        Increment the success/failure counters of a single service and month.
+
+        :param service_name: string name of the service (i.e. 'Comcast')
+        :param exec_time: datetime of the scraper execution
+        :param success: boolean result of the execution
+        :param previous_success: the result previously stored for this execution, or None if it is new
+        """
+        if previous_success == success:
+            return
+        counts = {'success_count': 0, 'failure_count': 0}
+        counts['success_count' if success else 'failure_count'] += 1
+        if previous_success is not None:
+            counts['success_count' if previous_success else 'failure_count'] -= 1
+        MonthlyRollup.objects(service_name=service_name, month=MonthlyRollup.month_start(exec_time))\
+            .update_one(inc__success_count=counts['success_count'], inc__failure_count=counts['failure_count'],
+                        upsert=True)
+
+    @staticmethod
+    def is_backfilled():
+        """
+        :return: True if MonthlyRollup.rebuild() has completed at least once
+        """
+        return RollupBackfill.objects().first() is not None
+
+    @staticmethod
+    def rebuild():
+        """
+        Recreate the whole rollup collection from the BillInfo, ExecutionStatus and
+        DailyExecutionSummary collections. Used to backfill after the rollups were introduced
+        or got out of sync.
+
+        The new rollups are written to a temporary collection that then atomically replaces the
+        live one, so readers never see an empty or partially rebuilt collection.
+
+        This is a maintenance operation that must not overlap scraper runs or compactions: rollup
+        updates made by save_no_dups while it runs are replaced by the rebuilt collection and lost.
+        Executions that a previous, interrupted compaction already merged into a
+        DailyExecutionSummary but did not delete are only counted once.
+
+        :return: the number of rollup documents written
+        """
+        rollups = {}
+
+        def get_rollup(group_id):
+            key = (group_id['service_name'], datetime(group_id['year'], group_id['month'], 1))
+            if key not in rollups:
+                rollups[key] = MonthlyRollup(service_name=key[0], month=key[1])
+            return rollups[key]
+
+        bill_groups = BillInfo.objects.aggregate(
+            {'$group': {
+                '_id': {'service_name': '$service_name', 'year': {'$year': '$date_due'},
+                        'month': {'$month': '$date_due'}},
+                'bill_total': {'$sum': '$amt_due'},
+                'bill_count': {'$sum': 1},
+                'bill_min': {'$min': '$amt_due'},
+                'bill_max': {'$max': '$amt_due'}
+            }}
+        )
+        for group in bill_groups:
+            rollup = get_rollup(group['_id'])
+            rollup.bill_total = group['bill_total']
+            rollup.bill_count = group['bill_count']
+            rollup.bill_min = group['bill_min']
+            rollup.bill_max = group['bill_max']
+
+        exec_groups = list(ExecutionStatus.objects(compaction_batch=None).aggregate(
+            {'$group': {
+                '_id': {'service_name': '$service_name', 'year': {'$year': '$exec_time'},
+                        'month': {'$month': '$exec_time'}},
+                'success_count': {'$sum': {'$cond': ['$success', 1, 0]}},
+                'failure_count': {'$sum': {'$cond': ['$success', 0, 1]}}
+            }}
+        ))
+
+        # Executions claimed by a compaction are skipped if their day was already merged into a summary
+        claimed_groups = ExecutionStatus.objects(compaction_batch__ne=None).aggregate(
+            {'$group': {
+                '_id': {'batch': '$compaction_batch', 'service_name': '$service_name',
+                        'year': {'$year': '$exec_time'}, 'month': {'$month': '$exec_time'},
+                        'day': {'$dayOfMonth': '$exec_time'}},
+                'success_count': {'$sum': {'$cond': ['$success', 1, 0]}},
+                'failure_count': {'$sum': {'$cond': ['$success', 0, 1]}}
+            }}
+        )
+        for group in claimed_groups:
+            group_id = group['_id']
+            day = datetime(group_id['year'], group_id['month'], group_id['day'])
+            if DailyExecutionSummary.objects(service_name=group_id['service_name'], day=day,
+                                             compaction_batches=group_id['batch']).first() is None:
+                exec_groups.append(group)
+
+        summary_groups = DailyExecutionSummary.objects.aggregate(
+            {'$group': {
+                '_id': {'service_name': '$service_name', 'year': {'$year': '$day'},
+                        'month': {'$month': '$day'}},
+                'success_count': {'$sum': '$success_count'},
+                'failure_count': {'$sum': '$failure_count'}
+            }}
+        )
+        for group in exec_groups + list(summary_groups):
+            rollup = get_rollup(group['_id'])
+            rollup.success_count += group['success_count']
+            rollup.failure_count += group['failure_count']
+
+        if not rollups:
+            MonthlyRollup.drop_collection()
+            RollupBackfill.mark_backfilled()
+            return 0
+
+        collection_name = MonthlyRollup._get_collection_name()
+        rebuilt = MonthlyRollup._get_db()[collection_name + '_rebuild']
+        rebuilt.drop()
+        rebuilt.create_index([('service_name', ASCENDING), ('month', ASCENDING)], unique=True)
+        rebuilt.insert_many([rollup.to_mongo() for rollup in rollups.values()])
+        rebuilt.rename(collection_name, dropTarget=True)
+        RollupBackfill.mark_backfilled()
+        return len(rollups)
+
+
+class RollupBackfill(Document):
+    """
+    Marker recording when the MonthlyRollup collection was last rebuilt from the raw collections
+    """
+    backfilled_at = DateTimeField(required=True)
+
+    @staticmethod
+    def mark_backfilled():
+        """
+        Record that MonthlyRollup.rebuild() has just completed
+        """
+        RollupBackfill.objects().update_one(set__backfilled_at=datetime.now(), upsert=True)
+
+
+class DailyExecutionSummary(Document, DatabaseItem, metaclass=Meta):
+    """
+    A per-day summary of the ExecutionStatus documents of a single service.
+
+    Raw ExecutionStatus documents older than the retention period are compacted into these
+    summaries and then deleted, so the ExecutionStatus collection only holds recent history
+    while long-term reliability trends are kept.
+
+    The retention period defaults to 30 days and can be configured with the
+    BILLS_EXECUTION_RETENTION_DAYS environment variable.
+    """
+    RETENTION_DAYS = int(os.environ.get('BILLS_EXECUTION_RETENTION_DAYS', 30))
+
+    service_name = StringField(required=True)
+    day = DateTimeField(required=True)
+    success_count = IntField(default=0)
+    failure_count = IntField(default=0)
+    duration_total = FloatField(default=0)
+    duration_count = IntField(default=0)
+    duration_min = FloatField()
+    duration_max = FloatField()
+    compaction_batches = ListField(StringField())
+
+    meta = {
+        'indexes': [
+            {'fields': ('service_name', 'day'), 'unique': True}
+        ]
+    }
+
+    def to_dict(self):
+        """
+        Convert object to dictionary for ease of loading into pandas for plotting
+
+        :return: a dictionary that represents this object
+        """
+        return {
+            "service_name": self.service_name,
+            "day": self.day,
+            "success_count": self.success_count,
+            "failure_count": self.failure_count,
+            "duration_mean": self.duration_total / self.duration_count if self.duration_count else None,
+            "duration_min": self.duration_min,
+            "duration_max": self.duration_max
+        }
+
+    def save_no_dups(self):
+        """
+        Merge this DailyExecutionSummary object into the database.
+
+        If there is already a document with this service name and day, add the counts and
+        durations of this object to it. Otherwise, create a new document. Nothing is merged if any
+        of the compaction batches of this object has already been merged, so a batch is only ever
+        counted once.
+        """
+        updates = {
+            'inc__success_count': self.success_count,
+            'inc__failure_count': self.failure_count,
+            'inc__duration_total': self.duration_total,
+            'inc__duration_count': self.duration_count,
+            'add_to_set__compaction_batches': self.compaction_batches
+        }
+        if self.duration_min is not None:
+            updates['min__duration_min'] = self.duration_min
+        if self.duration_max is not None:
+            updates['max__duration_max'] = self.duration_max
+        summary = DailyExecutionSummary.objects(service_name=self.service_name, day=self.day,
+                                                compaction_batches__nin=self.compaction_batches)
+        try:
+            summary.update_one(upsert=True, **updates)
+        except NotUniqueError:
+            # Either the summary already contains one of the batches, or another writer inserted it
+            # first. It exists now, so without upsert the filter merges or skips correctly.
+            summary.update_one(**updates)
+
+    @staticmethod
+    def compact_executions(retention_days=RETENTION_DAYS):
+        """
+        Summarize ExecutionStatus documents older than the retention period into per-day
+        summaries, then delete them.
+
+        Expired documents are first claimed by tagging them with a batch id. Each day of a batch
+        is merged into its summary together with the batch id, and then exactly the documents of
+        that day are deleted. A batch left behind by an interrupted run is finished by the next
+        run, and since a batch is merged at most once, interrupted or overlapping runs never
+        count a document twice.
+
+        :param retention_days: number of days of raw ExecutionStatus history to keep
+        :return: the number of ExecutionStatus documents that were compacted
+        """
+        today = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0)
+        cutoff = today - timedelta(days=retention_days)
+        ExecutionStatus.objects(exec_time__lt=cutoff, compaction_batch=None)\
+            .update(set__compaction_batch=uuid4().hex)
+
+        groups = ExecutionStatus.objects(exec_time__lt=cutoff, compaction_batch__ne=None).aggregate(
+            {'$group': {
+                '_id': {'batch': '$compaction_batch', 'service_name': '$service_name',
+                        'year': {'$year': '$exec_time'}, 'month': {'$month': '$exec_time'},
+                        'day': {'$dayOfMonth': '$exec_time'}},
+                'success_count': {'$sum': {'$cond': ['$success', 1, 0]}},
+                'failure_count': {'$sum': {'$cond': ['$success', 0, 1]}},
+                'duration_total': {'$sum': '$duration'},
+                'duration_count': {'$sum': {'$cond': [{'$gt': ['$duration', None]}, 1, 0]}},
+                'duration_min': {'$min': '$duration'},
+                'duration_max': {'$max': '$duration'},
+                'ids': {'$push': '$_id'}
+            }}
+        )
+        compacted = 0
+        for group in groups:
+            group_id = group.pop('_id')
+            ids = group.pop('ids')
+            DailyExecutionSummary(service_name=group_id['service_name'],
+                                  day=datetime(group_id['year'], group_id['month'], group_id['day']),
+                                  compaction_batches=[group_id['batch']], **group).save_no_dups()
+            compacted += ExecutionStatus.objects(id__in=ids).delete()
+
+        return compacted
 
 
 class ScrapeResultSaveHandler(Observer):
@@ -1,4 +1,5 @@
-from database import BillInfo, ExecutionStatus
+from cache import shared_cache
+from database import BillInfo, ExecutionStatus, MonthlyRollup
 from bokeh.models import LabelSet, ColumnDataSource
 from bokeh.layouts import gridplot
 from bokeh.plotting import figure
@@ -39,6 +40,7 @@ class Plotter(metaclass=ABCMeta):
         pass
 
     @staticmethod
+    @shared_cache.cached('unique_service_names')
     def get_unique_service_names():
         """
         :return: a list of unique service names from the database
@@ -63,10 +65,13 @@ class ExecutionStatusPlotter(Plotter):
         fail_data = pd.DataFrame([x.to_dict() for x in ExecutionStatus.objects(service_name=service_name, success=False).order_by('-exec_time')[:self.NUM_ITEMS_TO_PLOT]])
 
         p = figure(title=service_name, x_axis_type='datetime')
-        p.circle(pass_data.exec_time, pass_data.success, size=self.MARKER_SIZE, color='green', alpha=0.5)
+
+        # Either frame can be empty once old executions have been compacted away
+        if len(pass_data) > 0:
+            p.circle(pass_data.exec_time, pass_data.success, size=self.MARKER_SIZE, color='green', alpha=0.5)
 
         if len(fail_data) > 0:
-            p.circle(fail_data.exec_time, pass_data.success, size=self.MARKER_SIZE, color='red', alpha=0.5)
+            p.circle(fail_data.exec_time, fail_data.success, size=self.MARKER_SIZE, color='red', alpha=0.5)
 
         p.xaxis[0].axis_label = 'Scraper Execution Time'
         p.yaxis[0].axis_label = 'Pass/Fail'
@@ -85,6 +90,14 @@ class BillInfoPlotter(Plotter):
     def _get_plot_height_width_tuple(self):
         return 3, 10
 
+    @staticmethod
+    @shared_cache.cached('bill_info_service_names')
+    def get_unique_service_names():
+        """
+        :return: a list of unique service names that have billing information in the database
+        """
+        return BillInfo.objects().distinct(field='service_name')
+
     def _make_single_plot(self, service_name):
         df = pd.DataFrame([x.to_dict() for x in BillInfo.objects(service_name=service_name)])
         df['amt_str'] = df.apply(lambda row: '$' + str(row['amt_due']), axis=1)
@@ -102,6 +115,49 @@ class BillInfoPlotter(Plotter):
         return p
 
 
+class MonthlySummaryPlotter(Plotter):
+    """
+    Handles creating plots of monthly spend and scraper success rate from the pre-aggregated
+    MonthlyRollup collection
+    """
+
+    def __init__(self):
+        self.MARKER_SIZE = 10
+
+    def _get_plot_height_width_tuple(self):
+        return 3, 10
+
+    @staticmethod
+    @shared_cache.cached('monthly_rollup_service_names')
+    def get_unique_service_names():
+        """
+        :return: a list of unique service names that have monthly rollups in the database
+        """
+        return MonthlyRollup.objects().distinct(field='service_name')
+
+    def _make_single_plot(self, service_name):
+        df = pd.DataFrame([x.to_dict() for x in MonthlyRollup.objects(service_name=service_name).order_by('month')])
+        df['bill_total'] = df['bill_total'].astype(float)
+        runs = df['success_count'] + df['failure_count']
+        df['success_rate'] = (100 * df['success_count'] / runs.where(runs > 0)).fillna(0)
+        df['label'] = df.apply(lambda row: '${:.2f} ({:.0f}% ok)'.format(row['bill_total'], row['success_rate']),
+                               axis=1)
+
+        data = ColumnDataSource(df)
+
+        p = figure(title=service_name, x_axis_type='datetime')
+        p.vbar(x='month', top='bill_total', source=data, width=20 * 24 * 60 * 60 * 1000, alpha=0.5)
+
+        labels = LabelSet(x='month', y='bill_total', source=data, text='label', level='glyph', x_offset=-30,
+                          y_offset=5, render_mode='canvas')
+        p.add_layout(labels)
+
+        p.xaxis[0].axis_label = 'Month'
+        p.yaxis[0].axis_label = 'Total Billed'
+
+        return p
+
+
 if __name__ == "__main__":
     gp = ExecutionStatusPlotter().make_plot_layout()
     gp2 = BillInfoPlotter().make_plot_layout()
\ No newline at end of file
@@ -14,7 +14,7 @@ from email.mime.text import MIMEText
 from httplib2 import Http
 from oauth2client import file, client, tools
 from apiclient import errors
-from database import BillInfo, ExecutionStatus, ScrapeResultSaveHandler
+from database import BillInfo, ExecutionStatus, DailyExecutionSummary, ScrapeResultSaveHandler
 from bs4 import BeautifulSoup
 import re
 import sys
@@ -112,7 +112,9 @@ class BillDataScraper(metaclass=ABCMeta):
         """
         Perform the scraping operation and fire off an event that notifies listeners with the result
         """
+        start_time = datetime.now()
         result = self._get_bill_info()
+        result.exec_status.duration = (datetime.now() - start_time).total_seconds()
         # Fire off event to notify listeners
         Event(event_type=EventTypes.SCRAPING_EXECUTION_FINISHED, data=result)
 
@@ -383,3 +385,6 @@ if __name__ == "__main__":
 
     # Execute scraping operations
     scraperExecutor.get_bill_info()
+
+    # Compact execution history that is older than the retention period
+    DailyExecutionSummary.compact_executions(DailyExecutionSummary.RETENTION_DAYS)